@@ -34,5 +34,10 @@ relays = {
     'humidifier': humidifier,
 }
 
+# the set of relays is fixed at boot; cache the iteration lists so
+# callers that run every frame do not rebuild dict views each pass
+relay_items = list(relays.items())
+relay_list = [relay for _, relay in relay_items]
+
 display = tm1637.TM1637Decimal(clk=machine.Pin(DISPLAY_CLK_PIN),
                                dio=machine.Pin(DISPLAY_DIO_PIN))
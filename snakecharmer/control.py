@@ -1,16 +1,20 @@
 import uasyncio as asyncio
 
 import json
+from snakecharmer import logging
 from snakecharmer import tasks
 from snakecharmer import webserver
 
+event_poll_ms = const(100)  # NOQA
+
 sensors = {}
 config = {}
 
 
 # via https://github.com/peterhinch/micropython-async/blob/master/asyn.py
 class Event:
-    def __init__(self):
+    def __init__(self, delay_ms=event_poll_ms):
+        self.delay_ms = delay_ms
         self.clear()
 
     def clear(self):
@@ -20,8 +24,11 @@ class Event:
         self.flag = True
 
     def __await__(self):
+        # sleep between checks instead of rescheduling with sleep(0),
+        # which kept every waiter runnable on every scheduler pass and
+        # the event loop from ever idling
         while not self.flag:
-            yield from asyncio.sleep(0)
+            yield from asyncio.sleep_ms(self.delay_ms)
 
     __iter__ = __await__
 
@@ -30,6 +37,8 @@ def main():
     with open('config.json', 'r') as fd:
         config.update(json.load(fd))
 
+    logging.setLevel(config.get('loglevel', 'INFO'))
+
     loop = asyncio.get_event_loop()
     sensors_ready = Event()
     ws = webserver.Webserver(sensors, config)
@@ -46,7 +55,7 @@ def main():
 
     try:
         loop.run_forever()
-        loop.close()
     finally:
         for task in tasklist:
             task.close()
+        loop.close()
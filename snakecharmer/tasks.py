@@ -1,41 +1,106 @@
 import hardware as hw
 import uasyncio as asyncio
 import ubinascii as binascii
+import utime as time
+from snakecharmer import logging
 from snakecharmer import utils
 
+# a 12-bit ds18x20 conversion takes at most 750ms
+ds_convert_ms = const(750)  # NOQA
+# how often to check whether the conversions have finished
+ds_poll_ms = const(50)  # NOQA
+# wait this long before retrying a failed dht measurement
+dht_retry = const(2)  # NOQA
+
+
+display_frames = []
+
+# bumped at the end of every read cycle so consumers (e.g. the
+# webserver response cache) can tell when there is fresh data
+generation = 0
+
+
+def _update_display_frames(sensors, config):
+    # pre-render one label frame and one value frame per reading, so
+    # task_display does no formatting or unit conversion of its own.
+    # this runs once per sensor read rather than once per display tick.
+    use_f = config['units'] == 'f'
+
+    frames = []
+    for name, values in sensors.items():
+        for k, v in values.items():
+            if k == 't' and use_f:
+                v = '%0.1fF' % (v * 9 / 5 + 32,)
+            elif k == 't':
+                v = '%0.1fC' % (v,)
+            else:
+                v = '%0.1f' % (v,)
+
+            # label each reading with the sensor id it is published
+            # under, rather than an index derived from dict order.
+            # every ds id starts with the same 'ds-' prefix and
+            # 1-wire family code, so show the tail of the serial for
+            # those; the dht-N ids are distinct up front.
+            frames.append(name[-4:] if name.startswith('ds-')
+                          else name[:4])
+            frames.append('%s    ' % (v,))
+
+    display_frames[:] = frames
+
 
 async def task_display(sensors, config, wait_on=None):
+    # relay state frame, mutated in place each cycle: one ascii digit
+    # byte per relay ('1' = active) after the 'r' prefix
+    relay_frame = bytearray(b'r' + b'0' * len(hw.relay_list))
+
     hw.display.show('RUN ')
 
     if wait_on is not None:
-        print('* display: waiting for sensors')
+        logging.info('display: waiting for sensors')
         await wait_on
 
     try:
+        # step through the pre-rendered frames with a bare index: one
+        # show() per tick, and no iterator state to invalidate when
+        # task_read_sensors swaps the frame list mid-cycle.
+        idx = 0
         while True:
-            for i, values in enumerate(sensors.values()):
-                for k, v in values.items():
-                    if k == 't' and config['units'] == 'f':
-                        v = '%0.1fF' % (utils.C2F(v),)
-                    elif k == 't':
-                        v = '%0.1fC' % (v,)
-                    else:
-                        v = '%0.1f' % (v,)
-
-                    hw.display.show('S%d %s' % (i, k))
-                    await asyncio.sleep(1)
-                    hw.display.show('%s    ' % (v,))
-                    await asyncio.sleep(1)
-
-            r = ['%d' % (not x.value(),) for x in hw.relays.values()]
-            hw.display.show('r%s' % (''.join(r)))
-            await asyncio.sleep(config['display_interval'])
+            if idx < len(display_frames):
+                hw.display.show(display_frames[idx])
+                idx += 1
+                await asyncio.sleep(1)
+            else:
+                # end of the cycle: show the relay states, then rest
+                # until the next cycle starts.  the relays are active
+                # low, so value() == 0 means active.
+                for n, relay in enumerate(hw.relay_list):
+                    relay_frame[n+1] = 0x30 if relay.value() else 0x31
+                hw.display.show(str(relay_frame, 'utf-8'))
+                idx = 0
+                await asyncio.sleep(config['display_interval'])
     except GeneratorExit:
         hw.display.show('STOP')
 
 
 async def task_read_sensors(sensors, config, notify=None):
+    # the 1-wire rom search is a slow bus transaction and the id
+    # formatting allocates, while the set of attached sensors only
+    # changes at reboot: scan each bus once and cache the (rom, id)
+    # pairs.
+    ds_sensors = [
+        (bus, [(rom, 'ds-%s' % (binascii.hexlify(rom).decode(),))
+               for rom in bus.scan()])
+        for bus in hw.sensors_ds]
+    dht_sensors = [(sensor, 'dht-%d' % (i,))
+                   for i, sensor in enumerate(hw.sensors_dht)]
+
+    deadline = time.ticks_ms()
     while True:
+        deadline = time.ticks_add(deadline, config['read_interval'] * 1000)
+
+        # prep phase: start the (slow) ds18x20 temperature
+        # conversions, then read the dht sensors while the
+        # conversions are running.
         for bus in hw.sensors_ds:
             bus.convert_temp()
 
@@ -45,78 +110,128 @@ async def task_read_sensors(sensors, config, notify=None):
                     sensor.measure()
                     break
                 except OSError:
-                    await asyncio.sleep(2)
+                    await asyncio.sleep(dht_retry)
+
+        # a ds18x20 answers read slots with 0 while a conversion is
+        # running and 1 once it has finished: poll for completion
+        # rather than sleeping out the full worst-case conversion
+        # time, which the sensors usually beat by several hundred ms
+        waited = 0
+        while ds_sensors and waited < ds_convert_ms:
+            await asyncio.sleep_ms(ds_poll_ms)
+            waited += ds_poll_ms
+            if all(bus.ow.readbit() for bus, _ in ds_sensors):
+                break
+
+        # read phase: collect the converted values.  the sensor set is
+        # fixed after the startup scan, so update the reading dicts in
+        # place rather than rebuilding them each cycle; values land
+        # one key assignment at a time, which readers see atomically.
+        for bus, roms in ds_sensors:
+            for rom, id in roms:
+                reading = sensors.get(id)
+                if reading is None:
+                    sensors[id] = {'t': bus.read_temp(rom)}
+                else:
+                    reading['t'] = bus.read_temp(rom)
+
+        for sensor, id in dht_sensors:
+            reading = sensors.get(id)
+            if reading is None:
+                sensors[id] = {'t': sensor.temperature(),
+                               'h': sensor.humidity()}
+            else:
+                reading['t'] = sensor.temperature()
+                reading['h'] = sensor.humidity()
+
+        logging.debug('sensors:', sensors)
+        _update_display_frames(sensors, config)
+
+        global generation
+        generation += 1
 
-        # allow sensors to settle
-        await asyncio.sleep(1)
-
-        sensors.clear()
-        for bus in hw.sensors_ds:
-            for sensor in bus.scan():
-                id = 'ds-%s' % (binascii.hexlify(sensor).decode())
-                temp = bus.read_temp(sensor)
-                sensors[id] = {'t': temp}
-
-        for i, sensor in enumerate(hw.sensors_dht):
-            id = 'dht-%d' % (i,)
-            temp = sensor.temperature()
-            humid = sensor.humidity()
-            sensors[id] = {'t': temp, 'h': humid}
-
-        print('# sensors:', sensors)
         if notify is not None:
             notify.set()
-        await asyncio.sleep(config['read_interval'])
 
+        # sleep until the next absolute deadline rather than for a
+        # fixed interval, so the couple of seconds we spend on
+        # conversions does not accumulate into schedule drift.
+        await asyncio.sleep_ms(
+            max(0, time.ticks_diff(deadline, time.ticks_ms())))
+
+
+def _sensor_spec(sensor_name, k, relay_name):
+    # resolve the config key names and the relay object up front; the
+    # threshold and id values themselves stay live config lookups so
+    # they can be changed over the web interface.
+    return (sensor_name,
+            sensor_name + '_id',
+            k,
+            sensor_name + '_low',
+            sensor_name + '_high',
+            relay_name,
+            hw.relays[relay_name])
+
+
+def _handle_sensor(sensors, config, spec):
+    sensor_name, id_key, k, low_key, high_key, relay_name, relay = spec
 
-def _handle_sensor(sensors, config, sensor_name, k, relay_name):
-    print('* handling sensor %s -> %s' % (sensor_name, relay_name))
+    logging.debug('handling sensor', sensor_name, '->', relay_name)
 
-    sensor_id = config['%s_id' % (sensor_name,)]
-    sensor = sensors.get(sensor_id)
+    sensor = sensors.get(config[id_key])
     if sensor is None:
-        print('! no reading for sensor %s' % (sensor_name,))
+        logging.warning('no reading for sensor', sensor_name)
         return
 
     value = sensor.get(k)
     if value is None:
-        print('! no value for sensor %s key %s' % (sensor_name, k))
-        return
-
-    relay = hw.relays.get(relay_name)
-    if relay is None:
-        print('! no relay named %s' % (relay_name,))
+        logging.warning('no value for sensor', sensor_name, 'key', k)
         return
 
     if config.get('units', 'c') == 'f' and k == 't':
         value = utils.C2F(value)
 
-    low = config['%s_low' % (sensor_name,)]
-    high = config['%s_high' % (sensor_name,)]
+    low = config[low_key]
+    high = config[high_key]
 
+    # the relays are active low, so value() == 0 means active.  only
+    # touch the pin (and log) when the commanded state actually
+    # changes; between the thresholds the relay keeps its last state.
     if value <= low:
-        print('* %s value %f <= %f activating %s' % (
-            sensor_name, value, low, relay_name))
-        relay.off()
+        if relay.value():
+            logging.info('%s value %f <= %f activating %s' % (
+                sensor_name, value, low, relay_name))
+            relay.off()
     elif value >= high:
-        print('* %s value %f >= %f deactivating %s' % (
-            sensor_name, value, high, relay_name))
-        relay.on()
+        if not relay.value():
+            logging.info('%s value %f >= %f deactivating %s' % (
+                sensor_name, value, high, relay_name))
+            relay.on()
 
 
 async def task_control(sensors, config, wait_on=None):
+    specs = [
+        _sensor_spec('temp1', 't', 'heat1'),
+        _sensor_spec('temp2', 't', 'heat2'),
+        _sensor_spec('humid', 'h', 'humidifier'),
+    ]
+
     if wait_on is not None:
-        print('* control: waiting for sensors')
+        logging.info('control: waiting for sensors')
         await wait_on
 
     try:
+        deadline = time.ticks_ms()
         while True:
-            _handle_sensor(sensors, config, 'temp1', 't', 'heat1')
-            _handle_sensor(sensors, config, 'temp2', 't', 'heat2')
-            _handle_sensor(sensors, config, 'humid', 'h', 'humidifier')
+            deadline = time.ticks_add(
+                deadline, config['check_interval'] * 1000)
+
+            for spec in specs:
+                _handle_sensor(sensors, config, spec)
 
-            await asyncio.sleep(config['check_interval'])
+            await asyncio.sleep_ms(
+                max(0, time.ticks_diff(deadline, time.ticks_ms())))
     except GeneratorExit:
-        print('* deactivating all relays')
-        for relay in hw.relays.values():
+        logging.info('deactivating all relays')
+        for relay in hw.relay_list:
             relay.on()
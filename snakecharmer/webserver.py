@@ -3,7 +3,11 @@ import json
 import ure as re
 import sys
 
+from snakecharmer import logging
+from snakecharmer import tasks
+
 chunksize = const(256)  # NOQA
+max_request = const(1024)  # NOQA
 content_type_map = {
     'js': 'application/javascript',
     'png': 'image/png',
@@ -18,6 +22,8 @@ class Webserver:
     def __init__(self, sensors, config):
         self._sensors = sensors
         self._config = config
+        self._sensors_cache = None
+        self._sensors_gen = None
 
         self.routes = (
             ('/sensors', 'GET', self.sensors),
@@ -61,6 +67,33 @@ class Webserver:
         await writer.awrite(content)
         await writer.aclose()
 
+    async def send_json(self, writer, content, **kwargs):
+        # stream dicts one top-level item at a time rather than
+        # materializing the whole document with json.dumps(); the
+        # sensors and config dicts are the largest responses we send,
+        # and this keeps the peak allocation to a single item.  the
+        # body length is not known up front, so no content-length
+        # header is sent and closing the connection ends the body.
+        await self.send_header(writer,
+                               content_type='application/json',
+                               **kwargs)
+
+        if isinstance(content, dict):
+            await writer.awrite('{')
+            first = True
+            for k, v in content.items():
+                if not first:
+                    await writer.awrite(', ')
+                await writer.awrite(json.dumps(k))
+                await writer.awrite(': ')
+                await writer.awrite(json.dumps(v))
+                first = False
+            await writer.awrite('}')
+        else:
+            await writer.awrite(json.dumps(content))
+
+        await writer.aclose()
+
     async def send_file(self, writer, content, **kwargs):
         buf = bytearray(chunksize)
         bufview = memoryview(buf)
@@ -77,33 +110,77 @@ class Webserver:
         await writer.aclose()
 
     async def _handle_request(self, reader, writer, remote_addr):
-        line0 = None
-
-        while True:
-            line = (await reader.readline())
-
-            # read until we reach the end of the headers
-            # (or the end of data)
-            if not line or line == b'\r\n':
-                break
-
-            if line0 is None:
-                line0 = line.decode().strip().split(' ')
+        # accumulate the request head with bulk reads rather than one
+        # readline() per header, and cap its size so a client that
+        # dribbles headers out byte by byte gets bounded work.  the
+        # head fills a preallocated buffer instead of growing a bytes
+        # object, which would reallocate and recopy it on every read;
+        # the buffer is per-connection, since a shared one would be
+        # scribbled on by concurrent clients.
+        head = bytearray(max_request)
+        headlen = 0
+        end = -1
+        while end < 0:
+            if headlen >= max_request:
+                await self.send_response(
+                    writer,
+                    status=431,
+                    status_text='Request header fields too large')
+                return
+
+            chunk = await reader.read(max_request - headlen)
+            if not chunk:
+                return
+            head[headlen:headlen + len(chunk)] = chunk
+
+            # micropython's bytearray has no find(); scan for the
+            # end-of-head marker by hand, covering only the bytes the
+            # new chunk could have completed
+            start = headlen - 3 if headlen > 3 else 0
+            headlen += len(chunk)
+            for i in range(start, headlen - 3):
+                if (head[i] == 0x0d and head[i+1] == 0x0a
+                        and head[i+2] == 0x0d and head[i+3] == 0x0a):
+                    end = i
+                    break
+
+        lines = bytes(head[:end]).split(b'\r\n')
+        line0 = lines[0].decode().strip().split(' ')
+
+        headers = {}
+        for line in lines[1:]:
+            parts = line.decode().strip().split(':', 1)
+            if len(parts) == 2:
+                headers[parts[0].strip().lower()] = parts[1].strip()
 
         try:
             verb, uri = line0[:2]
         except (TypeError, ValueError):
-            print('! invalid request from', remote_addr)
+            logging.warning('invalid request from', remote_addr)
             return
 
-        print('* %s %s %s' % (remote_addr, verb, uri))
+        # anything past the blank line is the start of the body; read
+        # the rest here (bounded by content-length) rather than in the
+        # handlers, where an unbounded reader.read() would hang until
+        # the client closes the connection.
+        # convert to bytes once: json.loads will not take a bytearray
+        # on micropython
+        body = bytes(head[end+4:headlen])
+        want = int(headers.get('content-length', 0))
+        while len(body) < want:
+            chunk = await reader.read(want - len(body))
+            if not chunk:
+                break
+            body += chunk
+
+        logging.info(remote_addr, verb, uri)
 
         for route in self.routes:
             match = re.match(route[0], uri)
 
             if match and route[1] == verb:
                 handler = route[2]
-                await handler(reader, writer, match)
+                await handler(reader, writer, match, body)
                 break
         else:
             await self.send_response(writer,
@@ -121,67 +198,62 @@ class Webserver:
 
             await self._handle_request(reader, writer, remote_addr)
         except Exception as exc:
-            print('! error handling connection from', remote_addr)
+            logging.error('error handling connection from', remote_addr)
             sys.print_exception(exc)
         finally:
             await writer.aclose()
 
-    async def sensors(self, reader, writer, match):
+    async def sensors(self, reader, writer, match, body):
+        # the sensors dict only changes once per read cycle, but every
+        # client on the status page polls this endpoint: encode at
+        # most once per cycle and let concurrent polls share it
+        if self._sensors_gen != tasks.generation:
+            self._sensors_cache = json.dumps(self._sensors)
+            self._sensors_gen = tasks.generation
+
         await self.send_response(writer,
-                                 content=json.dumps(self._sensors),
+                                 content=self._sensors_cache,
                                  content_type='application/json')
 
-    async def one_sensor(self, reader, writer, match):
+    async def one_sensor(self, reader, writer, match, body):
         sensor_id = match.group(1)
-        await self.send_response(writer,
-                                 content=json.dumps(self._sensors[sensor_id]),
-                                 content_type='application/json')
+        await self.send_json(writer, self._sensors[sensor_id])
 
-    async def relays(self, reader, writer, match):
+    async def relays(self, reader, writer, match, body):
         relays = {k: int(not v.value())
-                  for k, v in hw.relays.items()}
+                  for k, v in hw.relay_items}
 
-        await self.send_response(writer,
-                                 content=json.dumps(relays),
-                                 content_type='application/json')
+        await self.send_json(writer, relays)
 
-    async def get_config(self, reader, writer, match):
-        await self.send_response(writer,
-                                 content=json.dumps(self._config),
-                                 content_type='application/json')
+    async def get_config(self, reader, writer, match, body):
+        await self.send_json(writer, self._config)
 
-    async def set_config(self, reader, writer, match):
-        new_config = json.loads(await reader.read())
+    async def set_config(self, reader, writer, match, body):
+        new_config = json.loads(body)
         self._config.update(new_config)
 
-        await self.send_response(writer,
-                                 content=json.dumps(self._config),
-                                 content_type='application/json')
+        await self.send_json(writer, self._config)
 
-    async def get_one_config(self, reader, writer, match):
+    async def get_one_config(self, reader, writer, match, body):
         k = match.group(1)
-        await self.send_response(writer,
-                                 content=json.dumps(self._config[k]),
-                                 content_type='application/json')
+        await self.send_json(writer, self._config[k])
 
-    async def set_one_config(self, reader, writer, match):
+    async def set_one_config(self, reader, writer, match, body):
         k = match.group(1)
-        v = json.loads(await reader.read())
-        print('* set config[%s] = %s' % (k, v))
+        v = json.loads(body)
+        logging.info('set config', k, '=', v)
 
         if not isinstance(v, type(self._config[k])):
             raise ValueError('wrong type for %s' % (k,))
 
         self._config[k] = v
-        await self.send_response(writer,
-                                 content=json.dumps(self._config[k]),
-                                 content_type='application/json')
+        await self.send_json(writer, self._config[k])
 
-    async def index(self, reader, writer, match):
+    async def index(self, reader, writer, match, body):
         with open('/static/status.html', 'rb') as fd:
             await self.send_file(writer, fd, content_type='text/html')
 
-    async def static(self, reader, writer, match):
+    async def static(self, reader, writer, match, body):
         filename = match.group(1)
         dot = filename.rfind('.')
         if dot >= 0: